@@ -1,66 +1,127 @@
-import xml.etree.ElementTree as ET
-from copy import deepcopy
+try:
+    import lxml.etree as ET
+    HAVE_LXML = True
+except ImportError:
+    import xml.etree.ElementTree as ET
+    HAVE_LXML = False
+try:
+    import libarchive
+    import libarchive.extract
+    HAVE_LIBARCHIVE = True
+except (ImportError, OSError):
+    HAVE_LIBARCHIVE = False
+from copy import copy
 import os
 import sys
 import shutil
 import zipfile
 import hashlib
+import zlib
 import re
+import struct
 from datetime import datetime
 import subprocess
 import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import time
 
+# Backup table name patterns
+BACKUP_TABLE_RE = re.compile(
+    r'_BK_\d'              # _BK_ followed by date
+    r'|_SL_BK_\d'          # _SL_BK_ followed by date
+    r'|_\d{8}[-_]\d{6}'    # Date pattern like _01052026-030119 or _05202025_100415
+)
+
+# model.xml checksum entry in Origin.xml
+CHECKSUM_START = b'<Checksum Uri="/model.xml">'
+CHECKSUM_END = b'</Checksum>'
+
+# Non-table element types copied from the bacpac model when missing from the base
+MERGED_ELEMENT_TYPES = ('SqlIndex', 'SqlPrimaryKeyConstraint', 'SqlForeignKeyConstraint', 'SqlDefaultConstraint', 'SqlView', 'SqlProcedure')
+
 # Define namespace
 NS = {'ns': 'http://schemas.microsoft.com/sqlserver/dac/Serialization/2012/02'}
+ELEMENT_TAG = f"{{{NS['ns']}}}Element"
+ENTRY_TAG = f"{{{NS['ns']}}}Entry"
+
+# Column elements of a table, relative to its SqlTable element
+COLUMNS_PATH = './/ns:Relationship[@Name="Columns"]/ns:Entry/ns:Element'
+if HAVE_LXML:
+    # Compile once and reuse for every table
+    find_columns = ET.XPath(COLUMNS_PATH, namespaces=NS)
+else:
+    def find_columns(element):
+        return element.findall(COLUMNS_PATH, NS)
+
+def remove_entries(entries):
+    """Delete os.DirEntry items in parallel; directories are removed recursively."""
+    def remove(entry):
+        if entry.is_dir(follow_symlinks=False):
+            shutil.rmtree(entry.path, ignore_errors=True)
+            return
+        try:
+            os.unlink(entry.path)
+        except OSError as e:
+            print(f"    Warning: Could not delete {entry.path}: {e}")
+    
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        list(executor.map(remove, entries))
 
 def cleanup_output_dir(output_dir):
     """Clean up the output directory contents before processing."""
     print(f"[0] Cleaning up output directory: {output_dir}")
     if os.path.exists(output_dir):
         # Delete contents but not the directory itself (for Docker volumes)
-        for item in os.listdir(output_dir):
-            item_path = os.path.join(output_dir, item)
-            try:
-                if os.path.isfile(item_path) or os.path.islink(item_path):
-                    os.unlink(item_path)
-                elif os.path.isdir(item_path):
-                    shutil.rmtree(item_path)
-            except Exception as e:
-                print(f"    Warning: Could not delete {item_path}: {e}")
+        with os.scandir(output_dir) as it:
+            entries = list(it)
+        remove_entries(entries)
     else:
         os.makedirs(output_dir, exist_ok=True)
     print(f"    Output directory ready")
 
-def calculate_sha256(file_path):
-    """Calculate SHA256 hash of a file."""
-    sha256_hash = hashlib.sha256()
-    with open(file_path, "rb") as f:
-        for byte_block in iter(lambda: f.read(4096), b""):
-            sha256_hash.update(byte_block)
-    return sha256_hash.hexdigest().upper()
+class HashingWriter:
+    """File wrapper that SHA256-hashes everything written through it."""
+    
+    def __init__(self, f):
+        self.f = f
+        self.sha256_hash = hashlib.sha256()
+    
+    def write(self, data):
+        self.sha256_hash.update(data)
+        return self.f.write(data)
+    
+    def hexdigest(self):
+        return self.sha256_hash.hexdigest().upper()
 
-def update_origin_checksum(extract_dir, model_xml_path):
-    """Update the checksum in Origin.xml to match the new model.xml."""
+def splice_checksum(origin_data, new_hash):
+    """Return Origin.xml bytes with the model.xml checksum replaced, or None if not found."""
+    start = origin_data.find(CHECKSUM_START)
+    if start < 0:
+        return None
+    start += len(CHECKSUM_START)
+    end = origin_data.find(CHECKSUM_END, start)
+    if end < 0:
+        return None
+    return origin_data[:start] + new_hash.encode('ascii') + origin_data[end:]
+
+def update_origin_checksum(extract_dir, new_hash):
+    """Update the checksum in Origin.xml to the new model.xml hash."""
     origin_path = os.path.join(extract_dir, "Origin.xml")
     
     if not os.path.exists(origin_path):
         print(f"    Warning: Origin.xml not found at {origin_path}")
         return False
     
-    new_hash = calculate_sha256(model_xml_path)
     print(f"    New model.xml hash: {new_hash}")
     
-    with open(origin_path, 'r', encoding='utf-8') as f:
+    with open(origin_path, 'rb') as f:
         content = f.read()
     
-    pattern = r'(<Checksum Uri="/model.xml">)[A-Fa-f0-9]+(</Checksum>)'
-    replacement = f'\\g<1>{new_hash}\\g<2>'
-    
-    new_content, count = re.subn(pattern, replacement, content)
+    new_content = splice_checksum(content, new_hash)
     
-    if count > 0:
-        with open(origin_path, 'w', encoding='utf-8') as f:
+    if new_content is not None:
+        with open(origin_path, 'wb') as f:
             f.write(new_content)
         print(f"    Updated Origin.xml checksum")
         return True
@@ -68,6 +129,103 @@ def update_origin_checksum(extract_dir, model_xml_path):
         print(f"    Warning: Could not find checksum pattern in Origin.xml")
         return False
 
+COPY_BUFFER_SIZE = 1 << 20
+
+if HAVE_LIBARCHIVE:
+    BAD_ARCHIVE_ERRORS = (zipfile.BadZipFile, libarchive.ArchiveError)
+else:
+    BAD_ARCHIVE_ERRORS = (zipfile.BadZipFile,)
+
+def member_path(extract_dir, name):
+    """Return the target path for a zip entry, or None if it would escape extract_dir."""
+    root = os.path.realpath(extract_dir)
+    dest = os.path.realpath(os.path.join(root, name))
+    if os.path.commonpath([dest, root]) != root:
+        return None
+    return dest
+
+def extract_member(zip_ref, zinfo, extract_dir):
+    """Extract a single zip entry with a buffered copy sized to the entry."""
+    dest = member_path(extract_dir, zinfo.filename)
+    if dest is None:
+        print(f"    Warning: Skipping unsafe path {zinfo.filename}")
+        return
+    if zinfo.is_dir():
+        os.makedirs(dest, exist_ok=True)
+        return
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    if zinfo.file_size == 0:
+        open(dest, 'wb').close()
+        return
+    buffer_size = min(zinfo.file_size, COPY_BUFFER_SIZE)
+    with zip_ref.open(zinfo) as src, open(dest, 'wb', buffering=buffer_size) as dst:
+        shutil.copyfileobj(src, dst, buffer_size)
+
+def extract_members_parallel(bacpac_path, entries, extract_dir):
+    """Extract entries on a thread pool; each worker reads through its own ZipFile handle."""
+    # Create all target directories up front so workers don't race on mkdir
+    for directory in {os.path.dirname(zinfo.filename) for zinfo in entries}:
+        dest = member_path(extract_dir, directory)
+        if dest is not None:
+            os.makedirs(dest, exist_ok=True)
+    
+    # Largest entries first for better load balance
+    entries = sorted(entries, key=lambda zinfo: zinfo.file_size, reverse=True)
+    
+    local = threading.local()
+    handles = []
+    
+    def extract_one(zinfo):
+        zip_ref = getattr(local, 'zip_ref', None)
+        if zip_ref is None:
+            zip_ref = local.zip_ref = zipfile.ZipFile(bacpac_path, 'r')
+            handles.append(zip_ref)
+        extract_member(zip_ref, zinfo, extract_dir)
+    
+    try:
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            # list() re-raises the first worker exception here
+            list(executor.map(extract_one, entries))
+    finally:
+        for zip_ref in handles:
+            zip_ref.close()
+
+def run_in_dir(directory, func, *args):
+    """Call func(*args) with directory as the working directory (libarchive works on relative paths)."""
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        return func(*args)
+    finally:
+        os.chdir(cwd)
+
+def extract_with_libarchive(bacpac_path, extract_dir):
+    """Extract the whole archive with libarchive, rejecting unsafe paths."""
+    flags = (libarchive.extract.EXTRACT_SECURE_NODOTDOT
+             | libarchive.extract.EXTRACT_SECURE_NOABSOLUTEPATHS
+             | libarchive.extract.EXTRACT_SECURE_SYMLINKS)
+    run_in_dir(extract_dir, libarchive.extract_file, os.path.abspath(bacpac_path), flags)
+
+def check_bacpac(bacpac_path):
+    """Check that the bacpac exists, is a valid archive and contains model.xml."""
+    print(f"[1] Opening {bacpac_path}...")
+    if not os.path.exists(bacpac_path):
+        print(f"Error: {bacpac_path} not found")
+        return False
+    
+    try:
+        with zipfile.ZipFile(bacpac_path, 'r') as zip_ref:
+            zip_ref.getinfo('model.xml')
+    except zipfile.BadZipFile:
+        print(f"    Error: Invalid bacpac file")
+        return False
+    except KeyError:
+        print("    Warning: model.xml not found")
+        return False
+    
+    print(f"    Found model.xml")
+    return True
+
 def extract_bacpac(bacpac_path, output_dir=None):
     """Extract .bacpac file and return path to model.xml."""
     if not os.path.exists(bacpac_path):
@@ -86,8 +244,12 @@ def extract_bacpac(bacpac_path, output_dir=None):
     print(f"[1] Extracting {bacpac_path}...")
     
     try:
-        with zipfile.ZipFile(bacpac_path, 'r') as zip_ref:
-            zip_ref.extractall(extract_dir)
+        if HAVE_LIBARCHIVE:
+            extract_with_libarchive(bacpac_path, extract_dir)
+        else:
+            with zipfile.ZipFile(bacpac_path, 'r') as zip_ref:
+                entries = zip_ref.infolist()
+            extract_members_parallel(bacpac_path, entries, extract_dir)
         print(f"    Extracted to: {extract_dir}")
         
         model_xml_path = os.path.join(extract_dir, "model.xml")
@@ -101,61 +263,257 @@ def extract_bacpac(bacpac_path, output_dir=None):
         print("    Warning: model.xml not found")
         return None, extract_dir
             
-    except zipfile.BadZipFile:
+    except BAD_ARCHIVE_ERRORS:
         print(f"    Error: Invalid bacpac file")
         return None, None
 
-def parse_model(filepath):
-    """Parse the XML model file."""
-    tree = ET.parse(filepath)
-    root = tree.getroot()
-    return tree, root
+def compress_file(file_path, level=zlib.Z_DEFAULT_COMPRESSION):
+    """Deflate a file in memory.
+
+    Returns (crc32, size, data) where data is the raw deflate stream, or None
+    when compressing does not shrink the file and it should be stored as is.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    crc = 0
+    size = 0
+    chunks = []
+    with open(file_path, 'rb') as f:
+        while True:
+            block = f.read(COPY_BUFFER_SIZE)
+            if not block:
+                break
+            crc = zlib.crc32(block, crc)
+            size += len(block)
+            chunks.append(compressor.compress(block))
+    chunks.append(compressor.flush())
+    data = b''.join(chunks)
+    if len(data) >= size:
+        return crc, size, None
+    return crc, size, data
+
+def write_raw_entry(zipf, zinfo, src):
+    """Append an entry whose payload is already in its final (compressed) form.
+
+    zinfo must carry CRC, sizes and compress_type; src is bytes or a binary file
+    object positioned at the payload, from which compress_size bytes are copied.
+    """
+    zinfo.header_offset = zipf.fp.tell()
+    zipf.fp.write(zinfo.FileHeader())
+    if isinstance(src, bytes):
+        zipf.fp.write(src)
+    else:
+        remaining = zinfo.compress_size
+        while remaining > 0:
+            block = src.read(min(remaining, COPY_BUFFER_SIZE))
+            if not block:
+                raise zipfile.BadZipFile(f"Truncated data for {zinfo.filename}")
+            zipf.fp.write(block)
+            remaining -= len(block)
+    zipf.start_dir = zipf.fp.tell()
+    zipf.filelist.append(zinfo)
+    zipf.NameToInfo[zinfo.filename] = zinfo
+
+def write_with_libarchive(new_bacpac_path, arcnames):
+    """Write the given relative paths into a deflated zip with libarchive."""
+    with libarchive.file_writer(new_bacpac_path, 'zip', options='compression=deflate') as archive:
+        archive.add_files(*arcnames)
+
+def repackage_bacpac(extract_dir, new_bacpac_path):
+    """Zip extract_dir into a new bacpac, deflating files on a thread pool (or with libarchive)."""
+    file_paths = []
+    for root, dirs, files in os.walk(extract_dir):
+        for file in files:
+            file_paths.append(os.path.join(root, file))
+    
+    if HAVE_LIBARCHIVE:
+        arcnames = [os.path.relpath(file_path, extract_dir) for file_path in file_paths]
+        run_in_dir(extract_dir, write_with_libarchive, os.path.abspath(new_bacpac_path), arcnames)
+        return
+    
+    max_workers = os.cpu_count() or 1
+    with zipfile.ZipFile(new_bacpac_path, 'w', zipfile.ZIP_DEFLATED) as zipf, \
+            ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # Keep a bounded window of pending results so memory stays proportional to the worker count
+        pending = deque()
+        paths = iter(file_paths)
+        while True:
+            while len(pending) < max_workers * 2:
+                file_path = next(paths, None)
+                if file_path is None:
+                    break
+                pending.append((file_path, executor.submit(compress_file, file_path)))
+            if not pending:
+                break
+            
+            file_path, future = pending.popleft()
+            crc, size, data = future.result()
+            zinfo = zipfile.ZipInfo.from_file(file_path, os.path.relpath(file_path, extract_dir))
+            zinfo.CRC = crc
+            zinfo.file_size = size
+            if data is None:
+                zinfo.compress_type = zipfile.ZIP_STORED
+                zinfo.compress_size = size
+                with open(file_path, 'rb') as f:
+                    write_raw_entry(zipf, zinfo, f)
+            else:
+                zinfo.compress_type = zipfile.ZIP_DEFLATED
+                zinfo.compress_size = len(data)
+                write_raw_entry(zipf, zinfo, data)
+
+def is_hangfire_item(item):
+    """Check if a Data/ item (a table's data folder) belongs to HangFire."""
+    return "HangFire" in item
+
+def is_hangfire_entry(name):
+    """Check if a bacpac entry holds HangFire table data (Data/HangFire.*/...)."""
+    parts = name.split('/')
+    return len(parts) > 1 and parts[0] == 'Data' and is_hangfire_item(parts[1])
+
+def strip_zip64_extra(extra):
+    """Drop the Zip64 extra field; FileHeader() adds a fresh one when needed."""
+    result = b''
+    i = 0
+    while i + 4 <= len(extra):
+        header_id, size = struct.unpack('<HH', extra[i:i + 4])
+        if header_id != 1:
+            result += extra[i:i + 4 + size]
+        i += 4 + size
+    return result
+
+def copy_raw_entry(src, zinfo, zipf):
+    """Copy an entry from an open archive file into zipf without inflating/deflating it."""
+    src.seek(zinfo.header_offset)
+    header = struct.unpack(zipfile.structFileHeader, src.read(zipfile.sizeFileHeader))
+    filename_length, extra_length = header[-2], header[-1]
+    src.seek(filename_length + extra_length, os.SEEK_CUR)
+    
+    new_info = copy(zinfo)
+    # Sizes and CRC go in the local header, so no trailing data descriptor
+    new_info.flag_bits &= ~0x08
+    new_info.extra = strip_zip64_extra(zinfo.extra)
+    write_raw_entry(zipf, new_info, src)
+
+def rewrite_bacpac(bacpac_path, new_bacpac_path, model_tree):
+    """Build a new bacpac from the original with model_tree as model.xml.
+
+    The model is serialized straight into the archive while being hashed, Origin.xml
+    gets the new checksum, and HangFire data is dropped. All other entries are copied
+    as raw compressed bytes, so unchanged table data is never decompressed.
+    """
+    removed = set()
+    with zipfile.ZipFile(bacpac_path, 'r') as source, open(bacpac_path, 'rb') as src, \
+            zipfile.ZipFile(new_bacpac_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
+        # model.xml goes first so its hash is known when Origin.xml is written
+        model_info = zipfile.ZipInfo('model.xml', date_time=time.localtime()[:6])
+        model_info.compress_type = zipfile.ZIP_DEFLATED
+        with zipf.open(model_info, 'w', force_zip64=True) as dst:
+            writer = HashingWriter(dst)
+            model_tree.write(writer, encoding='utf-8', xml_declaration=True)
+        new_hash = writer.hexdigest()
+        print(f"    New model.xml hash: {new_hash}")
+        
+        origin_found = False
+        for zinfo in source.infolist():
+            if zinfo.filename == 'model.xml':
+                continue
+            elif zinfo.filename == 'Origin.xml':
+                origin_found = True
+                origin_data = splice_checksum(source.read(zinfo), new_hash)
+                if origin_data is None:
+                    print(f"    Warning: Could not find checksum pattern in Origin.xml")
+                    copy_raw_entry(src, zinfo, zipf)
+                else:
+                    origin_info = zipfile.ZipInfo(zinfo.filename, date_time=zinfo.date_time)
+                    origin_info.compress_type = zipfile.ZIP_DEFLATED
+                    zipf.writestr(origin_info, origin_data)
+                    print(f"    Updated Origin.xml checksum")
+            elif is_hangfire_entry(zinfo.filename):
+                removed.add(zinfo.filename.split('/')[1])
+            else:
+                copy_raw_entry(src, zinfo, zipf)
+    
+    if not origin_found:
+        print(f"    Warning: Origin.xml not found in {bacpac_path}")
+    
+    for item in sorted(removed):
+        print(f"    Removed: {item}")
+    print(f"    Total removed: {len(removed)} HangFire data items")
+
+def parse_model(filepath, exclude_backups=False):
+    """Parse the XML model file.
+
+    With exclude_backups, backup and HangFire tables are removed while parsing
+    so their subtrees never stay in memory.
+    """
+    if not exclude_backups:
+        if HAVE_LXML:
+            parser = ET.XMLParser(huge_tree=True, collect_ids=False)
+            tree = ET.parse(filepath, parser)
+        else:
+            tree = ET.parse(filepath)
+        root = tree.getroot()
+        return tree, root
+    
+    if HAVE_LXML:
+        context = ET.iterparse(filepath, events=('end',), tag=ELEMENT_TAG, huge_tree=True, collect_ids=False)
+        for event, elem in context:
+            if elem.get('Type') == 'SqlTable' and is_backup_table(elem.get('Name') or ''):
+                parent = elem.getparent()
+                elem.clear()
+                if parent is not None:
+                    parent.remove(elem)
+    else:
+        # xml.etree elements don't know their parent, so track the open ones
+        context = ET.iterparse(filepath, events=('start', 'end'))
+        parents = []
+        for event, elem in context:
+            if event == 'start':
+                parents.append(elem)
+                continue
+            parents.pop()
+            if elem.tag == ELEMENT_TAG and elem.get('Type') == 'SqlTable' and parents \
+                    and is_backup_table(elem.get('Name') or ''):
+                elem.clear()
+                parents[-1].remove(elem)
+    root = context.root
+    return ET.ElementTree(root), root
 
 def is_backup_table(table_name):
     """Check if table is a backup table or should be excluded."""
-    # Exclude backup tables
-    backup_patterns = [
-        r'_BK_\d',           # _BK_ followed by date
-        r'_SL_BK_\d',        # _SL_BK_ followed by date
-        r'_\d{8}-\d{6}',     # Date pattern like _01052026-030119
-        r'_\d{8}_\d{6}',     # Date pattern like _05202025_100415
-    ]
-    for pattern in backup_patterns:
-        if re.search(pattern, table_name):
-            return True
-    
     # Exclude HangFire tables (they can cause FK constraint issues)
-    if '[HangFire]' in table_name or table_name.startswith('[HangFire].'):
+    if '[HangFire]' in table_name:
         return True
     
-    return False
+    # Exclude backup tables
+    return BACKUP_TABLE_RE.search(table_name) is not None
 
-def get_tables_with_columns(root, exclude_backups=True):
-    """Extract all SQL tables and their columns."""
+def index_model(root, exclude_backups=True):
+    """Index a model in one pass: tables with their columns, and MERGED_ELEMENT_TYPES elements by type."""
     tables = {}
-    for element in root.findall('.//ns:Element[@Type="SqlTable"]', NS):
-        table_name = element.get('Name')
-        if table_name:
+    elements = {}
+    for element in root.iter(ELEMENT_TAG):
+        name = element.get('Name')
+        if not name:
+            continue
+        element_type = element.get('Type')
+        if element_type == 'SqlTable':
             # Skip backup tables if requested
-            if exclude_backups and is_backup_table(table_name):
+            if exclude_backups and is_backup_table(name):
                 continue
             
-            columns = []
-            for col_entry in element.findall('.//ns:Relationship[@Name="Columns"]/ns:Entry/ns:Element', NS):
+            columns = {}
+            for col_entry in find_columns(element):
                 col_name = col_entry.get('Name')
                 if col_name:
-                    columns.append({'name': col_name, 'element': col_entry})
-            tables[table_name] = {'element': element, 'columns': columns}
-    return tables
-
-def get_all_elements_by_type(root, element_type):
-    """Get all elements of a specific type."""
-    elements = {}
-    for element in root.findall(f'.//ns:Element[@Type="{element_type}"]', NS):
-        name = element.get('Name')
-        if name:
-            elements[name] = element
-    return elements
+                    columns[col_name] = col_entry
+            tables[name] = {
+                'element': element,
+                'columns': columns,
+                'columns_rel': element.find('ns:Relationship[@Name="Columns"]', NS),
+            }
+        elif element_type in MERGED_ELEMENT_TYPES:
+            elements.setdefault(element_type, {})[name] = element
+    return tables, elements
 
 def generate_report(tables1, tables2):
     """Generate comparison report."""
@@ -180,8 +538,8 @@ def generate_report(tables1, tables2):
     
     missing_cols = []
     for table_name in sorted(set(tables1.keys()) & set(tables2.keys())):
-        cols1 = {col['name'] for col in tables1[table_name]['columns']}
-        cols2 = {col['name'] for col in tables2[table_name]['columns']}
+        cols1 = tables1[table_name]['columns'].keys()
+        cols2 = tables2[table_name]['columns'].keys()
         diff = cols2 - cols1
         if diff:
             missing_cols.append((table_name, len(diff)))
@@ -192,41 +550,71 @@ def generate_report(tables1, tables2):
     
     return missing_tables, missing_cols
 
-def merge_models(base_tree, base_root, new_root):
-    """Merge missing elements from new model into base model."""
+def find_duplicate_elements(root):
+    """Return names of top-level-typed elements that occur more than once in the model."""
+    seen = set()
+    duplicates = []
+    for element in root.iter(ELEMENT_TAG):
+        name = element.get('Name')
+        if name and (element.get('Type') == 'SqlTable' or element.get('Type') in MERGED_ELEMENT_TYPES):
+            if name in seen:
+                duplicates.append(name)
+            seen.add(name)
+    return duplicates
+
+def merge_models(base_tree, base_root, new_root, base_index=None, new_index=None):
+    """Merge missing elements from new model into base model.
+
+    base_index/new_index are optional results of index_model() to avoid re-walking the trees.
+    Elements are moved (lxml) or shared (xml.etree) rather than copied, so new_root
+    must not be used after merging.
+    """
     model_element = base_root.find('ns:Model', NS)
     if model_element is None:
         print("Error: Could not find Model element")
         return 0, 0, []
     
-    tables1 = get_tables_with_columns(base_root, exclude_backups=True)
-    tables2 = get_tables_with_columns(new_root, exclude_backups=True)
+    tables1, elements1 = base_index or index_model(base_root, exclude_backups=True)
+    tables2, elements2 = new_index or index_model(new_root, exclude_backups=True)
     
     added_tables = 0
     added_columns = 0
     added_columns_list = []
     
+    def register_merged(elem):
+        # Named elements inside a merged element (e.g. a constraint inside an added
+        # table) are now part of the base model too and must not be appended again
+        for nested in elem.iter(ELEMENT_TAG):
+            nested_type = nested.get('Type')
+            nested_name = nested.get('Name')
+            if nested_type in MERGED_ELEMENT_TYPES and nested_name:
+                elements1.setdefault(nested_type, {})[nested_name] = nested
+    
     for table_name, table_data in tables2.items():
         if table_name not in tables1:
-            model_element.append(deepcopy(table_data['element']))
+            table_element = table_data['element']
+            model_element.append(table_element)
+            register_merged(table_element)
             added_tables += 1
         else:
-            existing_col_names = {col['name'] for col in tables1[table_name]['columns']}
-            for col in table_data['columns']:
-                if col['name'] not in existing_col_names:
-                    columns_rel = tables1[table_name]['element'].find('ns:Relationship[@Name="Columns"]', NS)
-                    if columns_rel is not None:
-                        new_entry = ET.SubElement(columns_rel, '{http://schemas.microsoft.com/sqlserver/dac/Serialization/2012/02}Entry')
-                        new_entry.append(deepcopy(col['element']))
-                        added_columns += 1
-                        added_columns_list.append(f"{table_name}.{col['name']}")
-    
-    for elem_type in ['SqlIndex', 'SqlPrimaryKeyConstraint', 'SqlForeignKeyConstraint', 'SqlDefaultConstraint', 'SqlView', 'SqlProcedure']:
-        elements1 = get_all_elements_by_type(base_root, elem_type)
-        elements2 = get_all_elements_by_type(new_root, elem_type)
-        for elem_name, elem in elements2.items():
-            if elem_name not in elements1:
-                model_element.append(deepcopy(elem))
+            existing_cols = tables1[table_name]['columns']
+            columns_rel = tables1[table_name]['columns_rel']
+            if columns_rel is None:
+                continue
+            for col_name, col_element in table_data['columns'].items():
+                if col_name not in existing_cols:
+                    new_entry = ET.SubElement(columns_rel, ENTRY_TAG)
+                    new_entry.append(col_element)
+                    existing_cols[col_name] = col_element
+                    added_columns += 1
+                    added_columns_list.append(f"{table_name}.{col_name}")
+    
+    for elem_type in MERGED_ELEMENT_TYPES:
+        existing = elements1.setdefault(elem_type, {})
+        for elem_name, elem in elements2.get(elem_type, {}).items():
+            if elem_name not in existing:
+                model_element.append(elem)
+                register_merged(elem)
     
     return added_tables, added_columns, added_columns_list
 
@@ -272,7 +660,10 @@ def export_bacpac_from_azure(server, database, username, password, output_path):
     print(f"[*] This may take several minutes...\n")
     
     # Progress bar state
-    progress = {"running": True, "phase": "Connecting", "elapsed": 0}
+    # phase holds the latest SqlPackage output line once there is one
+    progress = {"phase": None, "elapsed": 0}
+    stop = threading.Event()
+    start_time = time.time()
     
     def progress_bar():
         """Display animated progress bar."""
@@ -287,15 +678,13 @@ def export_bacpac_from_azure(server, database, username, password, output_path):
         phase_idx = 0
         spinner = ['⠋', '⠙', '⠹', '⠸', '⠼', '⠴', '⠦', '⠧', '⠇', '⠏']
         spinner_idx = 0
-        start_time = time.time()
         
-        while progress["running"]:
+        while True:
             elapsed = int(time.time() - start_time)
-            progress["elapsed"] = elapsed
             
-            # Change phase every 30 seconds for visual feedback
+            # Show SqlPackage's own status; until it prints, change phase every 30 seconds
             phase_idx = min(elapsed // 30, len(phases) - 1)
-            current_phase = phases[phase_idx]
+            current_phase = (progress["phase"] or phases[phase_idx]).rstrip('.')[:36]
             
             # Create progress bar
             bar_width = 30
@@ -306,37 +695,86 @@ def export_bacpac_from_azure(server, database, username, password, output_path):
             mins, secs = divmod(elapsed, 60)
             time_str = f"{mins:02d}:{secs:02d}"
             
-            # Print progress
-            sys.stdout.write(f"\r{spinner[spinner_idx]} [{bar}] {time_str} | {current_phase}...")
+            # Print progress, padded so a shorter phase overwrites the previous one
+            status = f"{spinner[spinner_idx]} [{bar}] {time_str} | {current_phase}..."
+            sys.stdout.write("\r" + status.ljust(80))
             sys.stdout.flush()
             
             spinner_idx = (spinner_idx + 1) % len(spinner)
-            time.sleep(0.1)
+            # Redraw at 2 Hz; returns immediately once stop is set
+            if stop.wait(0.5):
+                break
         
         # Clear the progress line
         sys.stdout.write("\r" + " " * 80 + "\r")
         sys.stdout.flush()
     
-    # Start progress bar in background thread
-    progress_thread = threading.Thread(target=progress_bar, daemon=True)
-    progress_thread.start()
+    # Animate only on a terminal; non-TTY output (Docker logs) gets a status line every 30 seconds
+    progress_thread = None
+    if sys.stdout.isatty():
+        progress_thread = threading.Thread(target=progress_bar, daemon=True)
+        progress_thread.start()
+    
+    def stop_progress():
+        stop.set()
+        if progress_thread is not None:
+            progress_thread.join(timeout=1)
+        progress["elapsed"] = int(time.time() - start_time)
     
     try:
-        result = subprocess.run(
+        with subprocess.Popen(
             cmd,
-            capture_output=True,
-            text=True
-            # timeout removed
-        )
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            bufsize=1
+        ) as process:
+            try:
+                # Stream the output on a reader thread instead of buffering it all;
+                # keep the tail for error context
+                output_tail = deque(maxlen=200)
+                reader_errors = []
+        
+                def read_output():
+                    try:
+                        for line in process.stdout:
+                            line = line.strip()
+                            if line:
+                                output_tail.append(line)
+                                progress["phase"] = line
+                    except Exception as e:
+                        reader_errors.append(e)
+        
+                reader = threading.Thread(target=read_output, daemon=True)
+                reader.start()
+        
+                # Status line every 30 seconds whether or not SqlPackage prints anything
+                # (the reader finishes when SqlPackage closes its output or reading fails)
+                while True:
+                    reader.join(timeout=30)
+                    if not reader.is_alive():
+                        break
+                    if progress_thread is None:
+                        status = f"[*] Exporting... elapsed={int(time.time() - start_time)}s"
+                        if progress["phase"]:
+                            status += f" | {progress['phase']}"
+                        print(status, flush=True)
+                if reader_errors:
+                    raise reader_errors[0]
+                process.wait()
+            except BaseException:
+                # Like subprocess.run: never leave SqlPackage running when bailing out,
+                # including on Ctrl-C
+                process.kill()
+                raise
         
         # Stop progress bar
-        progress["running"] = False
-        progress_thread.join(timeout=1)
+        stop_progress()
         
         elapsed = progress["elapsed"]
         mins, secs = divmod(elapsed, 60)
         
-        if result.returncode == 0:
+        if process.returncode == 0:
             file_size = os.path.getsize(output_path) / (1024*1024)
             print(f"\n[✓] Export successful!")
             print(f"    Time: {mins}m {secs}s")
@@ -345,24 +783,27 @@ def export_bacpac_from_azure(server, database, username, password, output_path):
         else:
             print(f"\n[✗] Export failed!")
             print(f"    Time: {mins}m {secs}s")
-            print(f"    Error: {result.stderr}")
+            print(f"    Error: " + "\n".join(output_tail))
             return False
             
     except FileNotFoundError:
-        progress["running"] = False
-        progress_thread.join(timeout=1)
+        stop_progress()
         print(f"\n[✗] SqlPackage not found. Please install it or add to PATH.")
         print(f"    Download: https://docs.microsoft.com/en-us/sql/tools/sqlpackage-download")
         return False
     except Exception as e:
-        progress["running"] = False
-        progress_thread.join(timeout=1)
+        stop_progress()
         print(f"\n[✗] Export error: {e}")
         return False
 
-def process_bacpac(bacpac_path, base_model_path, output_dir=None):
+def process_bacpac(bacpac_path, base_model_path, output_dir=None, extract=False):
     """
     Main function: Extract bacpac, compare with base model, merge, update checksum, and repackage.
+
+    By default nothing is extracted: model.xml is parsed straight from the archive,
+    the merged model is streamed into the new bacpac and the remaining entries are
+    copied as-is. With extract=True the whole
+    archive is extracted to output_dir and re-zipped.
     """
     print("="*60)
     print("BACPAC MODEL SYNC TOOL")
@@ -374,72 +815,90 @@ def process_bacpac(bacpac_path, base_model_path, output_dir=None):
     # Step 0: Cleanup output directory
     cleanup_output_dir(output_dir)
     
-    # Step 1: Extract bacpac
-    extracted_model, extract_dir = extract_bacpac(bacpac_path, output_dir)
-    if not extracted_model:
-        print("Failed to extract bacpac")
-        return False
+    # Step 1: Extract bacpac, or just check model.xml can be read from it
+    if extract:
+        extracted_model, extract_dir = extract_bacpac(bacpac_path, output_dir)
+        if not extracted_model:
+            print("Failed to extract bacpac")
+            return False
+        bacpac_model = extracted_model
+    else:
+        if not check_bacpac(bacpac_path):
+            print("Failed to open bacpac")
+            return False
+        bacpac_model = f"{bacpac_path}:model.xml"
     
     # Step 2: Parse both models
     print(f"\n[2] Parsing models...")
     print(f"    Base model: {base_model_path}")
-    print(f"    Bacpac model: {extracted_model}")
+    print(f"    Bacpac model: {bacpac_model}")
     
     if not os.path.exists(base_model_path):
         print(f"    Error: Base model not found: {base_model_path}")
         return False
     
     base_tree, base_root = parse_model(base_model_path)
-    bacpac_tree, bacpac_root = parse_model(extracted_model)
+    if extract:
+        bacpac_tree, bacpac_root = parse_model(extracted_model, exclude_backups=True)
+    else:
+        # Stream model.xml out of the archive; nothing else is decompressed
+        with zipfile.ZipFile(bacpac_path, 'r') as zip_ref, zip_ref.open('model.xml') as f:
+            bacpac_tree, bacpac_root = parse_model(f, exclude_backups=True)
     
     # Step 3: Compare and generate report
     print(f"\n[3] Comparing models...")
-    tables_base = get_tables_with_columns(base_root)
-    tables_bacpac = get_tables_with_columns(bacpac_root)
-    generate_report(tables_base, tables_bacpac)
+    base_index = index_model(base_root)
+    bacpac_index = index_model(bacpac_root)
+    generate_report(base_index[0], bacpac_index[0])
     
     # Step 4: Merge missing elements into base model
     print(f"\n[4] Merging models...")
-    added_tables, added_columns, added_columns_list = merge_models(base_tree, base_root, bacpac_root)
+    added_tables, added_columns, added_columns_list = merge_models(base_tree, base_root, bacpac_root, base_index, bacpac_index)
     print(f"    Added {added_tables} tables, {added_columns} columns")
     
+    duplicates = find_duplicate_elements(base_root)
+    if duplicates:
+        print(f"    Warning: {len(duplicates)} element names appear more than once (import will fail)")
+        for name in duplicates[:10]:
+            print(f"      ! {name}")
+    
     if added_columns_list:
         print(f"\n    [COLUMNS ADDED]")
         for col in added_columns_list:
             print(f"      + {col}")
     
-    # Step 5: Save merged model
-    print(f"\n[5] Saving merged model...")
-    ET.register_namespace('', 'http://schemas.microsoft.com/sqlserver/dac/Serialization/2012/02')
-    
-    merged_output = os.path.join(output_dir, 'model_merged.xml')
-    base_tree.write(merged_output, encoding='utf-8', xml_declaration=True)
-    print(f"    Saved to: {merged_output}")
-    
-    # Step 6: Replace model in extracted bacpac
-    print(f"\n[6] Replacing model in extracted bacpac...")
-    shutil.copy2(merged_output, extracted_model)
-    print(f"    Replaced: {extracted_model}")
-    
-    # Step 7: Update Origin.xml checksum
-    print(f"\n[7] Updating Origin.xml checksum...")
-    update_origin_checksum(extract_dir, extracted_model)
+    if not HAVE_LXML:
+        # lxml keeps the source document's default namespace on its own
+        ET.register_namespace('', 'http://schemas.microsoft.com/sqlserver/dac/Serialization/2012/02')
     
-    # Step 7b: Clean HangFire data to avoid FK issues - MAKE SURE THIS IS CALLED
-    clean_hangfire_data(extract_dir)
-    
-    # Step 8: Repackage bacpac
-    print(f"\n[8] Repackaging bacpac...")
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     bacpac_name = os.path.splitext(os.path.basename(bacpac_path))[0]
     new_bacpac_path = os.path.join(output_dir, f"{bacpac_name}_updated_{timestamp}.bacpac")
     
-    with zipfile.ZipFile(new_bacpac_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-        for root, dirs, files in os.walk(extract_dir):
-            for file in files:
-                file_path = os.path.join(root, file)
-                arcname = os.path.relpath(file_path, extract_dir)
-                zipf.write(file_path, arcname)
+    if not extract:
+        # Step 5: Write the new bacpac, streaming the merged model straight into it
+        print(f"\n[5] Writing new bacpac...")
+        rewrite_bacpac(bacpac_path, new_bacpac_path, base_tree)
+    else:
+        # Step 5: Save merged model
+        print(f"\n[5] Saving merged model...")
+        # Write straight over the extracted model, hashing the bytes on the way out
+        with open(extracted_model, 'wb', buffering=COPY_BUFFER_SIZE) as f:
+            writer = HashingWriter(f)
+            base_tree.write(writer, encoding='utf-8', xml_declaration=True)
+        new_hash = writer.hexdigest()
+        print(f"    Saved to: {extracted_model}")
+        
+        # Step 6: Update Origin.xml checksum
+        print(f"\n[6] Updating Origin.xml checksum...")
+        update_origin_checksum(extract_dir, new_hash)
+        
+        # Step 6b: Clean HangFire data to avoid FK issues - MAKE SURE THIS IS CALLED
+        clean_hangfire_data(extract_dir)
+        
+        # Step 7: Repackage bacpac
+        print(f"\n[7] Repackaging bacpac...")
+        repackage_bacpac(extract_dir, new_bacpac_path)
     
     print(f"    Created: {new_bacpac_path}")
     
@@ -450,22 +909,20 @@ def process_bacpac(bacpac_path, base_model_path, output_dir=None):
     return True
 
 def clean_hangfire_data(extract_dir):
-    """Remove HangFire data files/directories to avoid FK constraint issues during import."""
-    print(f"\n[7b] Cleaning HangFire data files...")
+    """Remove HangFire data files/directories to avoid FK constraint issues during import.
+
+    Only needed after a full extraction; rewrite_bacpac() skips these entries itself.
+    """
+    print(f"\n[6b] Cleaning HangFire data files...")
     data_dir = os.path.join(extract_dir, "Data")
     if os.path.exists(data_dir):
-        removed = 0
-        for item in os.listdir(data_dir):
-            # Remove ALL HangFire related data files/directories
-            if item.startswith("HangFire.") or "HangFire" in item:
-                item_path = os.path.join(data_dir, item)
-                if os.path.isdir(item_path):
-                    shutil.rmtree(item_path)
-                else:
-                    os.remove(item_path)
-                print(f"    Removed: {item}")
-                removed += 1
-        print(f"    Total removed: {removed} HangFire data items")
+        # Remove ALL HangFire related data files/directories
+        with os.scandir(data_dir) as it:
+            entries = [entry for entry in it if is_hangfire_item(entry.name)]
+        remove_entries(entries)
+        for entry in entries:
+            print(f"    Removed: {entry.name}")
+        print(f"    Total removed: {len(entries)} HangFire data items")
     else:
         print(f"    No Data directory found")
 
@@ -482,6 +939,7 @@ def main():
     output_dir = os.environ.get('OUTPUT_DIR', './output')
     bacpac_dir = os.environ.get('BACPAC_DIR', './bacpac')
     bacpac_filename = os.environ.get('BACPAC_FILENAME', 'database.bacpac')
+    extract_bacpac_files = os.environ.get('EXTRACT_BACPAC', 'false').lower() == 'true'
     
     print(f"AUTO_EXPORT: {auto_export}")
     print(f"AZURE_SERVER: {azure_server}")
@@ -505,12 +963,12 @@ def main():
             return
     
     if bacpac_file:
-        process_bacpac(bacpac_file, model_file, output_dir)
+        process_bacpac(bacpac_file, model_file, output_dir, extract_bacpac_files)
     else:
         print("\nEnter paths:")
         bacpac_path = input("Bacpac file path: ").strip()
         model_path = input("Base model.xml path [model.xml]: ").strip() or "model.xml"
-        process_bacpac(bacpac_path, model_path, output_dir)
+        process_bacpac(bacpac_path, model_path, output_dir, extract_bacpac_files)
 
 if __name__ == "__main__":
     main()